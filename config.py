@@ -17,9 +17,20 @@ def get_channel_reaper_settings():
         "min_members": int(os.environ.get("MIN_MEMBERS", 0)),
         "ignore_bots": (os.environ.get("IGNORE_BOTS", "false") == "true"),
         "dry_run": (os.environ.get("DRY_RUN", "true") == "true"),
+        # number of channels whose history is fetched concurrently. Requests are
+        # limited to about one per second per api method, so a few workers is enough.
+        "max_workers": int(os.environ.get("MAX_WORKERS", 3)),
+        # seconds to wait for slack to connect / respond before giving up on a request.
+        "request_timeout": int(os.environ.get("REQUEST_TIMEOUT", 30)),
         "slack_token": os.environ.get("SLACK_TOKEN", ""),
         "bot_slack_token": os.environ.get("BOT_SLACK_TOKEN", ""),
-        "too_old_datetime": (datetime.now() - timedelta(days=days_inactive)),
+        "too_old_ts": (datetime.now() - timedelta(days=days_inactive)).timestamp(),
+        # channels seen active within CACHE_TTL_DAYS are not fetched again.
+        "cache_file": os.environ.get("CACHE_FILE", "channel_cache.sqlite"),
+        "cache_ttl_days": int(os.environ.get("CACHE_TTL_DAYS", 7)),
+        # the channel list is reused for CHANNEL_LIST_TTL_HOURS. 0 always lists them again.
+        "channel_list_cache_file": os.environ.get("CHANNEL_LIST_CACHE_FILE", "channel_list_cache.json"),
+        "channel_list_ttl_hours": int(os.environ.get("CHANNEL_LIST_TTL_HOURS", 6)),
         "whitelist_keywords": os.environ.get("WHITELIST_KEYWORDS", ""),
         "skip_subtypes": {"channel_leave", "channel_join"},
         "skip_channel_str": os.environ.get("SLACK_SKIP_PURPOSE", "%noarchive"),
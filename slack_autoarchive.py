@@ -3,16 +3,38 @@
 This program lets you do archive slack channels which are no longer active.
 """
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import os
+import random
+import re
+import sqlite3
 import sys
+import threading
 import time
 import json
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, it only makes parsing responses faster.
+    orjson = None
 
 from config import get_channel_reaper_settings
-from utils import get_logger
+from utils import get_logger, RateLimiter
+
+
+class SlackAPIError(Exception):
+    """
+    Raised when a slack api call fails, with the api method and slack's error code.
+    """
+
+    def __init__(self, api_endpoint, error):
+        super().__init__(f"{api_endpoint} failed: {error}")
+        self.api_endpoint = api_endpoint
+        self.error = error
 
 
 class ChannelReaper:
@@ -22,7 +44,58 @@ class ChannelReaper:
 
     def __init__(self):
         self.settings = get_channel_reaper_settings()
+        # settings read for every channel / message are looked up once here.
+        self._skip_subtypes = frozenset(self.settings.get("skip_subtypes") or ())
+        self._min_members = self.settings.get("min_members")
+        self._too_old_ts = self.settings.get("too_old_ts")
+        # files that don't change during a run are read once at startup.
+        with open("templates.json") as filecontent:
+            self._alerts = json.load(filecontent)
+        self._whitelist_re = self.compile_whitelist(self.get_whitelist_keywords())
+        # set once get_all_channels serves the channel list from disk.
+        self.channel_list_cached = False
         self.logger = get_logger("channel_reaper", "./audit.log")
+        self.session = self.get_http_session()
+        # one bucket per api method, since slack rate limits each method separately.
+        self.rate_limiters = {}
+        self.rate_limiters_lock = threading.Lock()
+        self.cache = self.get_cache(self.settings.get("cache_file"))
+        self.cache_lock = threading.Lock()
+
+    @staticmethod
+    def get_cache(cache_file):
+        """
+        Open the on-disk cache of each channel's last message timestamp, so
+        channels seen active on a previous run don't need to be fetched again.
+        """
+        cache = sqlite3.connect(cache_file, check_same_thread=False)
+        with cache:
+            cache.execute(
+                "CREATE TABLE IF NOT EXISTS last_message"
+                " (id TEXT PRIMARY KEY, last_ts REAL, fetched_at REAL, expires_at REAL)"
+            )
+        return cache
+
+    @staticmethod
+    def get_http_session():
+        """
+        Build a requests session which is shared by every Slack API call, so
+        connections (and their TLS handshakes) are reused via keep-alive.
+        """
+        session = requests.Session()
+        retries = Retry(
+            total=3,
+            backoff_factor=0.5,
+            # 429s are left to slack_api_http, so waits go through its rate limiter.
+            status_forcelist=[500, 502, 503, 504],
+            # hand the final response back so slack_api_http can handle it
+            raise_on_status=False,
+        )
+        session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries),
+        )
+        return session
 
     def get_whitelist_keywords(self):
         """
@@ -30,29 +103,35 @@ class ChannelReaper:
         purpose or topic, this will make the channel exempt from archiving.
         """
         keywords = []
-        if os.path.isfile("whitelist.txt"):
+        try:
             with open("whitelist.txt") as filecontent:
-                keywords = filecontent.readlines()
+                keywords = [line.strip() for line in filecontent if line.strip()]
+        except FileNotFoundError:
+            pass
 
-        # remove whitespace characters like `\n` at the end of each line
-        keywords = map(lambda x: x.strip(), keywords)
         whitelist_keywords = self.settings.get("whitelist_keywords")
         if whitelist_keywords:
-            keywords = keywords + whitelist_keywords.split(",")
-        return list(keywords)
+            keywords.extend(
+                keyword.strip() for keyword in whitelist_keywords.split(",") if keyword.strip()
+            )
+        return frozenset(keywords)
 
     def get_channel_alerts(self):
         """Get the alert message which is used to notify users in a channel of archival."""
-        with open("templates.json") as filecontent:
-            alerts = json.load(filecontent)
-        return alerts
+        return self._alerts
+
+    def get_rate_limiter(self, api_endpoint):
+        """Get (or create) the rate limiter for a slack api method."""
+        with self.rate_limiters_lock:
+            if api_endpoint not in self.rate_limiters:
+                self.rate_limiters[api_endpoint] = RateLimiter()
+            return self.rate_limiters[api_endpoint]
 
     def slack_api_http(
         self,
         api_endpoint=None,
         payload=None,
         method="GET",
-        retry_delay=0,
         as_bot=False,
     ):
         """Helper function to query the slack api and handle errors and rate limit."""
@@ -61,124 +140,246 @@ class ChannelReaper:
         headers = {
             "Authorization": f"Bearer {token}",
         }
-        try:
-            # Force request to take at least 1 second. Slack docs state:
+        timeout = self.settings.get("request_timeout")
+        rate_limiter = self.get_rate_limiter(api_endpoint)
+        for _ in range(5):
+            # Limit each method to one request per second. Slack docs state:
             # > In general we allow applications that integrate with Slack to send
             # > no more than one message per second. We allow bursts over that
             # > limit for short periods.
-            if retry_delay > 0:
-                time.sleep(retry_delay)
+            rate_limiter.acquire()
 
             if method == "POST":
-                response = requests.post(uri, data=payload, headers=headers)
+                response = self.session.post(uri, data=payload, headers=headers, timeout=timeout)
             else:
-                response = requests.get(uri, params=payload, headers=headers)
+                response = self.session.get(uri, params=payload, headers=headers, timeout=timeout)
 
-            if (
-                response.status_code == requests.codes.ok
-                and "error" in response.json()
-                and response.json()["error"] == "not_authed"
-            ):
-                self.logger.error(
-                    "Need to setup auth. eg, SLACK_TOKEN=<secret token> python slack-autoarchive.py"
-                )
-                sys.exit(1)
-            elif response.status_code == requests.codes.ok and response.json()["ok"]:
-                return response.json()
-            elif response.status_code == requests.codes.too_many_requests:
-                retry_timeout = float(response.headers["Retry-After"])
-                return self.slack_api_http(api_endpoint, payload, method, retry_timeout)
-        except Exception as error_msg:
-            raise Exception(error_msg)
-        return None
+            if response.status_code != requests.codes.too_many_requests:
+                break
+            # slack throttles the whole method, so every worker waits, not just this one.
+            rate_limiter.pause(float(response.headers.get("Retry-After", 1)))
+        else:
+            raise SlackAPIError(api_endpoint, "ratelimited")
+
+        if response.status_code != requests.codes.ok:
+            raise SlackAPIError(api_endpoint, f"http_{response.status_code}")
+
+        try:
+            body = orjson.loads(response.content) if orjson else response.json()
+        except ValueError:
+            # eg. an html error page from a proxy, whichever parser is used.
+            raise SlackAPIError(api_endpoint, "invalid_json") from None
+        if body.get("error") == "not_authed":
+            self.logger.error(
+                "Need to setup auth. eg, SLACK_TOKEN=<secret token> python slack-autoarchive.py"
+            )
+            sys.exit(1)
+        if not body.get("ok"):
+            raise SlackAPIError(api_endpoint, body.get("error", "unknown_error"))
+        return body
+
+    def get_cached_channel_list(self):
+        """Return the channel list saved by a previous run, or None if it is missing or too old."""
+        ttl_hours = self.settings.get("channel_list_ttl_hours")
+        if not ttl_hours:
+            return None
+        try:
+            with open(self.settings.get("channel_list_cache_file")) as filecontent:
+                cached = json.load(filecontent)
+        except (FileNotFoundError, ValueError):
+            return None
+        if cached.get("fetched_at", 0) < time.time() - ttl_hours * 3600:
+            return None
+        return cached.get("channels")
+
+    def set_cached_channel_list(self, channels):
+        """Save the channel list so runs within CHANNEL_LIST_TTL_HOURS can reuse it."""
+        if not self.settings.get("channel_list_ttl_hours"):
+            return
+        with open(self.settings.get("channel_list_cache_file"), "w") as filecontent:
+            json.dump({"fetched_at": time.time(), "channels": channels}, filecontent)
 
     def get_all_channels(self):
-        """Get a list of all non-archived channels from slack channels.list."""
-        # TODO: Add support for more than 1000 channels.
+        """
+        Yield all non-archived channels from slack conversations.list, one page
+        at a time, so channels can be processed while later pages are fetched.
+        A list saved by a recent run is reused instead of listing them again.
+        """
+        cached_channels = self.get_cached_channel_list()
+        if cached_channels is not None:
+            self.channel_list_cached = True
+            yield from cached_channels
+            return
+
         payload = {
             "exclude_archived": 1,
-            "limit": 1000,
+            "limit": 200,
         }
         api_endpoint = "conversations.list"
-        channels = self.slack_api_http(api_endpoint=api_endpoint, payload=payload)[
-            "channels"
-        ]
         all_channels = []
-        for channel in channels:
-            all_channels.append(
-                {
-                    "id": channel["id"],
-                    "name": channel["name"],
-                    "created": channel["created"],
-                    "num_members": channel["num_members"],
-                    "topic": channel["topic"]["value"],
-                    "purpose": channel["purpose"]["value"],
-                }
+        while True:
+            response = self.slack_api_http(api_endpoint=api_endpoint, payload=payload)
+            all_channels.extend(response["channels"])
+            yield from response["channels"]
+
+            next_cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not next_cursor:
+                break
+            payload["cursor"] = next_cursor
+        self.set_cached_channel_list(all_channels)
+
+    def get_channel_info(self, channel_id):
+        """Get the current state of a channel from slack conversations.info."""
+        payload = {"channel": channel_id, "include_num_members": 1}
+        api_endpoint = "conversations.info"
+        return self.slack_api_http(api_endpoint=api_endpoint, payload=payload)["channel"]
+
+    def get_channel_history(self, channel_id):
+        """
+        Get the latest messages of a channel. Only a few messages are fetched at
+        first, larger older pages are only fetched while every message is a
+        skipped subtype, up to a few pages.
+        """
+        payload = {"channel": channel_id, "inclusive": 0, "oldest": 0, "limit": 5}
+        api_endpoint = "conversations.history"
+        skip_subtypes = self._skip_subtypes
+
+        for _ in range(3):
+            channel_history = self.slack_api_http(
+                api_endpoint=api_endpoint, payload=payload
             )
-        return all_channels
+            if any(
+                message.get("subtype") not in skip_subtypes
+                for message in channel_history.get("messages", [])
+            ):
+                return channel_history
 
-    def get_last_message_timestamp(self, channel_history, too_old_datetime):
-        """Get the last message from a slack channel, and return the time."""
-        last_message_datetime = too_old_datetime
+            next_cursor = channel_history.get("response_metadata", {}).get("next_cursor")
+            if not next_cursor:
+                break
+            payload["cursor"] = next_cursor
+            payload["limit"] = 200
 
-        if not channel_history:
-            return datetime.utcfromtimestamp(0)
+        # only skipped messages found, so the channel creation time is used instead.
+        return channel_history
+
+    def get_last_message_timestamp(self, channel_history, too_old_ts):
+        """Get the last message from a slack channel, and return its unix timestamp."""
+        last_message_ts = too_old_ts
 
         if "messages" not in channel_history:
-            return last_message_datetime  # no messages
+            return last_message_ts  # no messages
 
+        skip_subtypes = self._skip_subtypes
         for message in channel_history["messages"]:
-            if "subtype" in message and message["subtype"] in self.settings.get(
-                "skip_subtypes"
-            ):
+            if message.get("subtype") in skip_subtypes:
                 continue
-            last_message_datetime = datetime.fromtimestamp(float(message["ts"]))
+            last_message_ts = float(message["ts"])
             break
 
-        # for folks with the free plan, sometimes there is no last message,
-        # then just set last_message_datetime to epoch
-        if not last_message_datetime:
-            last_message_datetime = datetime.utcfromtimestamp(0)
+        return last_message_ts
 
-        return last_message_datetime
+    def get_cached_last_message_ts(self, channel_id):
+        """
+        Return the cached last message timestamp of a channel, or None if it
+        isn't cached or has expired.
+        """
+        with self.cache_lock:
+            row = self.cache.execute(
+                "SELECT last_ts, expires_at FROM last_message WHERE id=?", (channel_id,)
+            ).fetchone()
+        if not row or time.time() >= row[1]:
+            return None
+        return row[0]
+
+    def set_cached_last_message_ts(self, channel_id, last_ts):
+        """
+        Store the last message timestamp of a channel. Each entry expires at a
+        random point in the last 30% of CACHE_TTL_DAYS, so channels cached on
+        the same run don't all expire on the same later run.
+        """
+        fetched_at = time.time()
+        ttl = self.settings.get("cache_ttl_days") * 86400
+        expires_at = fetched_at + ttl * (1 - 0.3 * random.random())
+        with self.cache_lock, self.cache:
+            self.cache.execute(
+                "INSERT OR REPLACE INTO last_message (id, last_ts, fetched_at, expires_at) VALUES (?, ?, ?, ?)",
+                (channel_id, last_ts, fetched_at, expires_at),
+            )
+
+    def has_min_users(self, channel):
+        """Return True if a channel is small enough to be archived (see MIN_MEMBERS)."""
+        min_members = self._min_members
+        return min_members == 0 or min_members > channel["num_members"]
 
-    def is_channel_disused(self, channel, too_old_datetime):
+    def refresh_archive_candidate(self, channel):
+        """
+        Get the current state of a channel found from a cached channel list, and
+        return it if the channel should still be archived, otherwise None.
+        """
+        try:
+            channel = self.get_channel_info(channel["id"])
+        except (SlackAPIError, requests.RequestException) as error:
+            self.logger.warning("Skipping channel %s: %s", channel["name"], error)
+            return None
+        if (
+            channel.get("is_archived")
+            or not self.has_min_users(channel)
+            or self.is_channel_whitelisted(channel)
+        ):
+            return None
+        return channel
+
+    def is_channel_disused(self, channel, too_old_ts):
         """Return True or False depending on if a channel is "active" or not."""
-        num_members = channel["num_members"]
-        payload = {"inclusive": 0, "oldest": 0, "count": 50}
-        api_endpoint = "conversations.history"
+        # Channels with too many members are never archived, so don't fetch them.
+        if not self.has_min_users(channel):
+            return False
 
-        payload["channel"] = channel["id"]
-        channel_history = self.slack_api_http(
-            api_endpoint=api_endpoint, payload=payload
-        )
-        last_message_datetime = self.get_last_message_timestamp(
-            channel_history, datetime.fromtimestamp(float(channel["created"]))
+        # New messages can only make a channel more active, so a cached message
+        # newer than the cut off still proves the channel is in use. Channels that
+        # look disused are always fetched again before being archived.
+        cached_ts = self.get_cached_last_message_ts(channel["id"])
+        if cached_ts is not None and cached_ts > too_old_ts:
+            return False
+
+        try:
+            channel_history = self.get_channel_history(channel["id"])
+        except (SlackAPIError, requests.RequestException) as error:
+            # don't archive a channel we couldn't read.
+            self.logger.warning("Skipping channel %s: %s", channel["name"], error)
+            return False
+        last_message_ts = self.get_last_message_timestamp(
+            channel_history, float(channel["created"])
         )
+        self.set_cached_last_message_ts(channel["id"], last_message_ts)
 
-        last_message_is_too_old = last_message_datetime <= too_old_datetime
-        min_members = self.settings.get("min_members")
-        has_min_users = min_members == 0 or min_members > num_members
+        return last_message_ts <= too_old_ts
 
-        return last_message_is_too_old and has_min_users
+    @staticmethod
+    def compile_whitelist(white_listed_channels):
+        """
+        Compile the whitelist keywords into a single regex matching any of them,
+        or None if there are no keywords.
+        """
+        keywords = (channel.strip().strip("#") for channel in white_listed_channels)
+        keywords = [re.escape(keyword) for keyword in keywords if keyword]
+        if not keywords:
+            return None
+        return re.compile("|".join(keywords))
 
     # If you add channels to the WHITELIST_KEYWORDS constant they will be exempt from archiving.
-    def is_channel_whitelisted(self, channel, white_listed_channels):
+    def is_channel_whitelisted(self, channel):
         """Return True or False depending on if a channel is exempt from being archived."""
-        channel_purpose = channel["purpose"]
-        channel_topic = channel["topic"]
+        skip_channel_str = self.settings.get("skip_channel_str")
         if (
-            self.settings.get("skip_channel_str") in channel_purpose
-            or self.settings.get("skip_channel_str") in channel_topic
+            skip_channel_str in channel["purpose"]["value"]
+            or skip_channel_str in channel["topic"]["value"]
         ):
             return True
 
         # check the white listed channels (file / env)
-        for white_listed_channel in white_listed_channels:
-            wl_channel_name = white_listed_channel.strip("#")
-            if wl_channel_name in channel["name"]:
-                return True
-        return False
+        return bool(self._whitelist_re and self._whitelist_re.search(channel["name"]))
 
     def send_channel_message(self, channel_id, message):
         """Send a message to a channel or user."""
@@ -192,17 +393,32 @@ class ChannelReaper:
         self.slack_api_http(api_endpoint=api_endpoint, payload=payload, method="POST", as_bot=True)
 
     def archive_channel(self, channel, alert):
-        """Archive a channel, and send alert to slack admins."""
+        """Archive a channel, and send alert to slack admins. Return True on success."""
         api_endpoint = "conversations.archive"
         stdout_message = "Archiving channel... %s" % channel["name"]
         self.logger.info(stdout_message)
 
         if not self.settings.get("dry_run"):
             channel_message = alert.format(days_inactive=self.settings.get("days_inactive"))
-            self.send_channel_message(channel["id"], channel_message)
-            payload = {"channel": channel["id"]}
-            self.slack_api_http(api_endpoint=api_endpoint, payload=payload)
+            try:
+                self.send_channel_message(channel["id"], channel_message)
+                payload = {"channel": channel["id"]}
+                self.slack_api_http(api_endpoint=api_endpoint, payload=payload)
+            except (SlackAPIError, requests.RequestException) as error:
+                self.logger.error("Failed to archive channel %s: %s", channel["name"], error)
+                return False
             self.logger.info(stdout_message)
+        return True
+
+    def archive_disused_channel(self, channel):
+        """Archive a channel found to be disused, and return it if it was archived, otherwise None."""
+        # a cached channel list may be hours old, so recheck the channel first.
+        if self.channel_list_cached:
+            channel = self.refresh_archive_candidate(channel)
+            if not channel:
+                return None
+        alert = self.get_channel_alerts()["channel_template"]
+        return channel if self.archive_channel(channel, alert) else None
 
     def send_admin_report(self, channels):
         """Optionally this will message admins with which channels were archived."""
@@ -211,13 +427,16 @@ class ChannelReaper:
             admin_msg = "Archiving %d channels: %s" % (len(channels), channel_names)
             if self.settings.get("dry_run"):
                 admin_msg = "[DRY RUN] %s" % admin_msg
-            self.send_channel_message(self.settings.get("admin_channel"), admin_msg)
+            try:
+                self.send_channel_message(self.settings.get("admin_channel"), admin_msg)
+            except (SlackAPIError, requests.RequestException) as error:
+                self.logger.error("Failed to send admin report: %s", error)
 
     def generate_report(self, channels):
         """Generate a report. Usual for a dry-run or after a run."""
         file_name = f'report-{datetime.now().strftime("%m%d%Y%H%M%S")}.txt'
-        with open(file_name, "w") as f:
-            f.write("\n".join(str(channel["name"]) for channel in channels))
+        with open(file_name, "w", buffering=1 << 16) as f:
+            f.writelines(f'{channel["name"]}\n' for channel in channels)
 
     def main(self):
         """
@@ -226,25 +445,40 @@ class ChannelReaper:
         if self.settings.get("dry_run"):
             self.logger.info("THIS IS A DRY RUN. NO CHANNELS ARE ACTUALLY ARCHIVED.")
 
-        whitelist_keywords = self.get_whitelist_keywords()
-        alert_templates = self.get_channel_alerts()
-        archived_channels = []
-
-        for channel in self.get_all_channels():
-            sys.stdout.write(".")
-            sys.stdout.flush()
-
-            channel_whitelisted = self.is_channel_whitelisted(
-                channel, whitelist_keywords
-            )
-            channel_disused = self.is_channel_disused(
-                channel, self.settings.get("too_old_datetime")
-            )
-            if not channel_whitelisted and channel_disused:
-                archived_channels.append(channel)
-                self.archive_channel(channel, alert_templates["channel_template"])
-
-        self.send_admin_report(archived_channels)
+        with self.session:
+            # conversations.history is pure network wait, so fan the per-channel
+            # lookups out over a few workers and collect the disused channels.
+            too_old_ts = self._too_old_ts
+            with ThreadPoolExecutor(max_workers=self.settings.get("max_workers")) as executor:
+                futures = {}
+                try:
+                    # whitelisted channels are skipped before any history is fetched.
+                    for channel in self.get_all_channels():
+                        if not self.is_channel_whitelisted(channel):
+                            futures[executor.submit(self.is_channel_disused, channel, too_old_ts)] = channel
+                    for processed, future in enumerate(as_completed(futures), 1):
+                        if processed % 50 == 0:
+                            self.logger.info("Checked %d of %d channels", processed, len(futures))
+                        future.result()
+                except BaseException:
+                    # don't wait for every queued channel before the error surfaces.
+                    for future in futures:
+                        future.cancel()
+                    raise
+            # keep the channels in listing order, so the report is the same on every run.
+            disused_channels = [channel for future, channel in futures.items() if future.result()]
+
+            # chat.postMessage and conversations.archive are rate limited separately,
+            # so two workers keep one channel's message and another's archive in flight.
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                archived_channels = [
+                    channel
+                    for channel in executor.map(self.archive_disused_channel, disused_channels)
+                    if channel
+                ]
+
+            self.send_admin_report(archived_channels)
+        self.cache.close()
         self.generate_report(archived_channels)
 
 
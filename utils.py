@@ -1,6 +1,8 @@
 """ Helper functions that don't quite belong in the slack_autoarchive class """
 
 import logging
+import threading
+import time
 
 
 def get_logger(logger_name, logger_file, log_level=logging.INFO):
@@ -24,3 +26,25 @@ def get_logger(logger_name, logger_file, log_level=logging.INFO):
     logging.getLogger(logger_name).addHandler(console)
 
     return logging.getLogger(logger_name)
+
+
+class RateLimiter:
+    """ Block callers so that at most one call is let through per interval. """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.next_allowed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Wait until the next call is allowed, then reserve the slot after it. """
+        with self.lock:
+            delay = self.next_allowed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_allowed = time.monotonic() + self.interval
+
+    def pause(self, seconds):
+        """ Hold back every caller for at least `seconds`, eg. after slack returned a 429. """
+        with self.lock:
+            self.next_allowed = max(self.next_allowed, time.monotonic() + seconds)